@@ -3,8 +3,10 @@ import argparse
 import logging
 import math
 import re
+from itertools import islice
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass, field
 from datetime import datetime, time, date, timedelta, timezone
-import xml.etree.ElementTree as ET
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="{levelname:8} {message}", style='{', level=logging.INFO)
@@ -21,128 +23,248 @@ VBOX_DATA_SECTION = 'data'
 VBOX_SECTION_ORDER = [VBOX_PREAMBLE_SECTION, VBOX_HEADER_SECTION, VBOX_AVI_SECTION, VBOX_COMMENTS_SECTION,
                       VBOX_LAPTIMING_SECTION, VBOX_COLUMN_NAMES_SECTION, VBOX_DATA_SECTION]
 
+# VboxSections attribute holding each section
+VBOX_SECTION_FIELDS = {VBOX_PREAMBLE_SECTION: 'preamble', VBOX_HEADER_SECTION: 'header', VBOX_AVI_SECTION: 'avi',
+                       VBOX_COMMENTS_SECTION: 'comments', VBOX_LAPTIMING_SECTION: 'laptiming',
+                       VBOX_COLUMN_NAMES_SECTION: 'column_names', VBOX_DATA_SECTION: 'data'}
 
-def read_vbox_sections(vbox_lines: list[str]) -> dict[str, list[str]]:
+VBOX_WRITE_BUFFER_SIZE = 1 << 20  # merged vbox is typically several megabytes
+VBOX_WRITE_CHUNK_LINES = 10000  # data lines are about 100-300 characters
+
+VIDEO_FILENAME_RE = re.compile(r'(?P<prefix>[a-zA-Z]+)(?P<number>\d+)\.(?P<extension>\w+)')
+
+
+@dataclass
+class TelemetryData:
+    """Telemetry from the data section
+
+    Data lines are kept as read, a column is split out of them only when it is needed.
+    New and replaced columns are stored column-wise (values are strings), in the order they were set.
+    """
+    column_names: list[str]  # columns in data lines
+    lines: list[str]
+    columns: dict[str, list[str]] = field(default_factory=dict)
+
+
+@dataclass
+class VboxSections:
+    """Lines of each known vbox section, data section is read into TelemetryData"""
+    # explicit slots (and no field defaults) - dataclass(slots=True) needs Python 3.10
+    __slots__ = ('preamble', 'header', 'avi', 'comments', 'laptiming', 'column_names', 'data')
+    preamble: list[str]  # pseudo section - everything before the first section
+    header: list[str]
+    avi: list[str]
+    comments: list[str]
+    laptiming: list[str]
+    column_names: list[str]
+    data: TelemetryData
+
+
+def read_vbox_sections(vbox_lines: Iterable[str]) -> VboxSections:
     """Groups vbox lines into sections
-    
+
+    Lines are consumed one by one, so an open file can be passed directly.
     There is a special section 'preamble' which contains everything before the first section.
+    Unknown sections are skipped.
     """
-    vbox_section_contents = {VBOX_PREAMBLE_SECTION: []}
-    current_section = VBOX_PREAMBLE_SECTION
+    section_contents = {section_field: [] for section_field in VBOX_SECTION_FIELDS.values()}
+    section_lines = section_contents['preamble']
     for line in vbox_lines:
         line = line.strip()
         if line.startswith('[') and line.endswith(']'):
-            current_section = line[1:-1]
-            vbox_section_contents[current_section] = list()
+            section_name = line[1:-1]
+            section_lines = list()
+            if section_name in VBOX_SECTION_FIELDS:
+                section_contents[VBOX_SECTION_FIELDS[section_name]] = section_lines
+            else:
+                logger.debug(f"Skipping unknown section: {section_name}")
         elif line:  # skip empty lines
-            vbox_section_contents[current_section].append(line)
-    return vbox_section_contents
+            section_lines.append(line)
+
+    column_names = section_contents['column_names'][0].split() if section_contents['column_names'] else []
+    section_contents['data'] = TelemetryData(column_names, section_contents['data'])
+    return VboxSections(**section_contents)
+
+
+def iter_telemetry_column(telemetry_data: TelemetryData, column_name: str) -> Iterator[str]:
+    """Column values, data lines are split only up to the column and one at a time"""
+    if column_name in telemetry_data.columns:
+        return iter(telemetry_data.columns[column_name])
+    col_idx = telemetry_data.column_names.index(column_name)
+    return (data_line.split(maxsplit=col_idx + 1)[col_idx] for data_line in telemetry_data.lines)
+
 
+def telemetry_data_to_lines(telemetry_data: TelemetryData) -> Iterator[str]:
+    """Lines with only new columns have them appended as is, lines are split/joined when columns are replaced
 
-def write_vbox_sections(vbox_sections: list[str], filename):
+    Lines are produced one at a time while iterating.
+    Whether a column is replaced or new is decided by the fields of the first data line,
+    column names may already list columns that data lines don't have:
+
+    >>> telemetry_data = TelemetryData(['time', 'heading', 'avisynctime'], ['101010.00 305.08', '101010.10 305.10'])
+    >>> telemetry_data.columns['avisynctime'] = ['0', '100']
+    >>> list(telemetry_data_to_lines(telemetry_data))
+    ['101010.00 305.08 0', '101010.10 305.10 100']
+
+    Following lines may be shorter than the first one, their fields are kept:
+
+    >>> telemetry_data = TelemetryData(['time', 'h', 'avifileindex', 'avisynctime'], ['1 9 a b', '2 8'])
+    >>> telemetry_data.columns.update(avifileindex=['X', 'X'], avisynctime=['0', '1'])
+    >>> list(telemetry_data_to_lines(telemetry_data))
+    ['1 9 X 0', '2 8 X 1']
+
+    Columns missing from a shorter line are appended to it, not padded:
+
+    >>> telemetry_data = TelemetryData(['time', 'avifileindex', 'avisynctime', 'h'], ['1 a b 7', '2'])
+    >>> telemetry_data.columns.update(avifileindex=['X', 'X'], avisynctime=['0', '1'])
+    >>> list(telemetry_data_to_lines(telemetry_data))
+    ['1 X 0 7', '2 X 1']
+    """
+    for column_name, values in telemetry_data.columns.items():  # zip() below would silently drop lines
+        if len(values) != len(telemetry_data.lines):
+            raise ValueError(f"Column {column_name} has {len(values)} values for {len(telemetry_data.lines)} data lines")
+    if not telemetry_data.lines:
+        return iter(())
+    column_count = len(telemetry_data.lines[0].split())  # columns data lines already have
+    column_indices = {column_name: col_idx for col_idx, column_name in enumerate(telemetry_data.column_names)}
+
+    replaced_columns = {column_indices[column_name]: values
+                        for column_name, values in telemetry_data.columns.items()
+                        if column_indices.get(column_name, column_count) < column_count}
+    # in column names order, columns not in column names go last
+    appended_column_names = sorted((column_name for column_name in telemetry_data.columns
+                                    if column_indices.get(column_name, column_count) >= column_count),
+                                   key=lambda column_name: column_indices.get(column_name, len(column_indices)))
+    appended_columns = [telemetry_data.columns[column_name] for column_name in appended_column_names]
+    _join = ' '.join  # bound once for the per line loops below
+
+    if not replaced_columns:
+        # no need to split data lines - new columns are just appended to each line
+        if not appended_columns:
+            return iter(telemetry_data.lines)
+        return (data_line + ' ' + _join(new_values)
+                for data_line, new_values in zip(telemetry_data.lines, zip(*appended_columns)))
+
+    replaced_col_indices = list(replaced_columns)
+
+    def patch_data_lines():
+        for data_line, new_values in zip(telemetry_data.lines, zip(*replaced_columns.values(), *appended_columns)):
+            data_row = data_line.split()
+            for col_idx, value in zip(replaced_col_indices, new_values):
+                if col_idx < len(data_row):
+                    data_row[col_idx] = value
+                else:  # following lines may be shorter than the first one
+                    data_row.append(value)
+            data_row.extend(new_values[len(replaced_col_indices):])
+            yield _join(data_row)
+
+    return patch_data_lines()
+
+
+def write_vbox_sections(vbox_sections, filename):
     logger.info(f"Writing merged vbox...")
-    merged_vbox_lines = []
-    for section_name in VBOX_SECTION_ORDER:
-        if section_name != VBOX_PREAMBLE_SECTION:  # do not write preamble section
-            merged_vbox_lines.append('\n')
-            merged_vbox_lines.append(f'[{section_name}]\n')
-        for section_line in vbox_sections[section_name]:
-            merged_vbox_lines.append(section_line + '\n')
-    with open(filename, mode='w') as vbox_file:
-        vbox_file.writelines(merged_vbox_lines)
+    with open(filename, mode='w', buffering=VBOX_WRITE_BUFFER_SIZE) as vbox_file:
+        for section_name in VBOX_SECTION_ORDER:
+            if section_name != VBOX_PREAMBLE_SECTION:  # do not write preamble section
+                vbox_file.write(f'\n[{section_name}]\n')
+            section_lines = getattr(vbox_sections, VBOX_SECTION_FIELDS[section_name])
+            if section_name == VBOX_DATA_SECTION:
+                section_lines = telemetry_data_to_lines(section_lines)
+            # joined in chunks - a whole section (data) is never held as one string
+            section_lines = iter(section_lines)
+            while section_lines_chunk := list(islice(section_lines, VBOX_WRITE_CHUNK_LINES)):
+                vbox_file.write('\n'.join(section_lines_chunk) + '\n')
 
 
 def patch_headers(vbox_sections):
     logger.info(f"Patching headers...")
-    if not 'avifileindex' in vbox_sections[VBOX_HEADER_SECTION]:
-        vbox_sections[VBOX_HEADER_SECTION].append('avifileindex')
-    if not 'avisynctime' in vbox_sections[VBOX_HEADER_SECTION]:
-        vbox_sections[VBOX_HEADER_SECTION].append('avisynctime')
-    logger.debug(f"New headers: {vbox_sections[VBOX_HEADER_SECTION]}")
+    if not 'avifileindex' in vbox_sections.header:
+        vbox_sections.header.append('avifileindex')
+    if not 'avisynctime' in vbox_sections.header:
+        vbox_sections.header.append('avisynctime')
+    logger.debug(f"New headers: {vbox_sections.header}")
 
 
 def get_telemetry_column_names(vbox_sections) -> list[str]:
-    return vbox_sections[VBOX_COLUMN_NAMES_SECTION][0].split()
+    return vbox_sections.data.column_names
 
 
-def patch_column_names(vbox_sections) -> list[str]:
+def patch_column_names(vbox_sections, column_names: list[str]) -> list[str]:
+    """Patch column names section, column_names (as read from it) are left intact"""
     logger.info(f"Patching column names...")
-    column_names_list = vbox_sections[VBOX_COLUMN_NAMES_SECTION][0].split()
+    column_names_list = list(column_names)
     if not 'avifileindex' in column_names_list:
         column_names_list.append('avifileindex')
     if not 'avisynctime' in column_names_list:
         column_names_list.append('avisynctime')
-    vbox_sections[VBOX_COLUMN_NAMES_SECTION][0] = ' '.join(column_names_list)
-    logger.debug(f"New column names: {vbox_sections[VBOX_COLUMN_NAMES_SECTION][0]}")
+    vbox_sections.column_names[0] = ' '.join(column_names_list)
+    logger.debug(f"New column names: {vbox_sections.column_names[0]}")
     return column_names_list
 
 
 def insert_avi_section(vbox_sections, video_prefix: str, video_extension: str):
     logger.info(f"Inserting avi section...")
-    vbox_sections[VBOX_AVI_SECTION] = [video_prefix, video_extension]
-    logger.debug(f"avi section: {vbox_sections[VBOX_AVI_SECTION]}")
+    vbox_sections.avi = [video_prefix, video_extension]
+    logger.debug(f"avi section: {vbox_sections.avi}")
+
 
+def line_times_to_msec(line_times: Iterable[float]) -> list[int]:
+    """Get time in milliseconds since midnight for each line time
 
-def line_time_to_sec_and_time(line_time) -> tuple[float, time]:
-    """Get time in seconds from line time
-    
     Recorded time in each row is not in seconds -
     it's encoded by shifting hours, minutes and seconds into places
     """
-
-    line_time_decimal_part, line_time_integer_part = math.modf(line_time)
-
-    line_time_msec = round(line_time_decimal_part * 100)  # rounded to hundredth
-
-    line_time_integer_part = int(line_time_integer_part)
-
-    line_hour = int(line_time_integer_part / 10000)
-
-    line_minutes = int((line_time_integer_part - line_hour * 10000)  / 100)
-
-    line_seconds = int(line_time_integer_part - line_hour * 10000 - line_minutes * 100)
-
-    seconds_since_midnight = line_hour * 60 * 60 +  line_minutes * 60 + line_seconds + line_time_msec / 100
-
-    return seconds_since_midnight, time(line_hour, line_minutes, line_seconds, line_time_msec * 1000)
-
-
-def get_telemetry_start_time(vbox_sections, column_names: list[str]) -> time:
-    time_col_idx = column_names.index('time')
-    _, start_time = line_time_to_sec_and_time(float(vbox_sections[VBOX_DATA_SECTION][0].split()[time_col_idx]))
-    return start_time
-
-
-def patch_data(vbox_sections, column_names: list[str], video_number: str, video_offset_sec: float):
+    line_times_msec = []
+    # local names for the hot loop - saves global and attribute lookups per line
+    _modf = math.modf
+    _round = round
+    _append = line_times_msec.append
+    for line_time in line_times:
+        line_time_decimal_part, line_time_integer_part = _modf(line_time)
+        line_time_integer_part = int(line_time_integer_part)
+        line_time_hundreds = line_time_integer_part // 100  # hhmm, minutes and hours are both derived from it
+        line_hour = line_time_hundreds // 100
+        _append(line_hour * 60 * 60 * 1000 + (line_time_hundreds - line_hour * 100) * 60 * 1000 +
+                (line_time_integer_part - line_time_hundreds * 100) * 1000 +
+                _round(line_time_decimal_part * 100) * 10)  # rounded to hundredth
+    return line_times_msec
+
+
+def line_time_to_msec_and_time(line_time) -> tuple[int, time]:
+    """Get time in milliseconds since midnight and time from line time (decoded by line_times_to_msec)"""
+    msec_since_midnight = line_times_to_msec([line_time])[0]
+
+    line_seconds_since_midnight, line_time_msec = divmod(msec_since_midnight, 1000)
+    line_minutes_since_midnight, line_seconds = divmod(line_seconds_since_midnight, 60)
+    line_hour, line_minutes = divmod(line_minutes_since_midnight, 60)
+    line_time_msec //= 10  # hundredths, as recorded
+
+    return msec_since_midnight, time(line_hour, line_minutes, line_seconds, line_time_msec * 1000)
+
+
+def get_telemetry_start_time(vbox_sections) -> tuple[int, time]:
+    """Get telemetry start time both in milliseconds since midnight and as time"""
+    telemetry_data = vbox_sections.data
+    time_col_idx = telemetry_data.column_names.index('time')
+    return line_time_to_msec_and_time(float(telemetry_data.lines[0].split()[time_col_idx]))
+
+
+def patch_data(vbox_sections, video_number: str, video_offset_sec: float, initial_time_msec: int):
+    """Set avifileindex and avisynctime columns of the data section
+
+    Only the time column is decoded, the two video columns are assigned as a whole.
+    Sync time is computed in integer milliseconds.
+    """
     logger.info(f"Patching data...")
-    new_data_lines = list()
-
-    time_col_idx = column_names.index('time')
-    avifileindex_col_idx = column_names.index('avifileindex')
-    avisynctime_col_idx = column_names.index('avisynctime')
-    
-    initial_time_sec, _ = line_time_to_sec_and_time(float(vbox_sections[VBOX_DATA_SECTION][0].split()[time_col_idx]))
-
-    for data_line in vbox_sections[VBOX_DATA_SECTION]:
-        data_line_elements = data_line.split()
-        line_time_sec, _ = line_time_to_sec_and_time(float(data_line_elements[time_col_idx]))
-        line_offset_sec = line_time_sec - initial_time_sec  # offset from beginning of telemetry
-
-        line_video_offset_msec = round((video_offset_sec + line_offset_sec) * 1000)
+    telemetry_data = vbox_sections.data
 
-        if avifileindex_col_idx < len(data_line_elements):
-            data_line_elements[avifileindex_col_idx] = video_number
-        else:
-            data_line_elements.append(video_number)
+    line_times_msec = line_times_to_msec(map(float, iter_telemetry_column(telemetry_data, 'time')))
 
-        if avisynctime_col_idx < len(data_line_elements):
-            data_line_elements[avisynctime_col_idx] = line_video_offset_msec
-        else:
-            data_line_elements.append(str(line_video_offset_msec))
-        
-        new_data_lines.append(' '.join(data_line_elements))
-    
-    vbox_sections[VBOX_DATA_SECTION] = new_data_lines
+    telemetry_data.columns['avifileindex'] = [video_number] * len(line_times_msec)
+    # offset from beginning of telemetry shifted by video offset
+    video_sync_offset_msec = round(video_offset_sec * 1000) - initial_time_msec
+    telemetry_data.columns['avisynctime'] = [str(line_time_msec + video_sync_offset_msec)
+                                             for line_time_msec in line_times_msec]
 
 
 def time_to_timedelta(time_obj: time) -> timedelta:
@@ -150,22 +272,45 @@ def time_to_timedelta(time_obj: time) -> timedelta:
                      seconds=time_obj.second, microseconds=time_obj.microsecond)
 
 def get_probable_offset_from_sony_metadata(telemetry_start_time, metadata_filename):
-    SONY_META_XMLNS = 'urn:schemas-professionalDisc:nonRealTimeMeta:ver.2.00'
-    tree = ET.parse(metadata_filename)
+    # imported here so that merging without metadata doesn't pay for it
+    try:
+        from lxml import etree as ET  # libxml2 based, faster
+    except ImportError:
+        import xml.etree.ElementTree as ET
 
-    creation_date_element = tree.find(f'{{{SONY_META_XMLNS}}}CreationDate')
-    creation_date = datetime.fromisoformat(creation_date_element.attrib['value'])
+    SONY_META_XMLNS = 'urn:schemas-professionalDisc:nonRealTimeMeta:ver.2.00'
+    creation_date_path = [f'{{{SONY_META_XMLNS}}}CreationDate']
+    gps_group_path = [f'{{{SONY_META_XMLNS}}}AcquisitionRecord', f'{{{SONY_META_XMLNS}}}Group']
+    gps_item_path = gps_group_path + [f'{{{SONY_META_XMLNS}}}Item']
+
+    # single pass over the metadata, elements are picked up on start (attributes are already there)
+    creation_date = gps_timestamp = gps_datestamp = None
+    element_path = []  # tags from the root down to the current element
+    in_gps_group = False
+    for event, element in ET.iterparse(metadata_filename, events=('start', 'end')):
+        if event == 'end':
+            element_path.pop()
+            element.clear()
+            continue
+        element_path.append(element.tag)
+        if element_path[1:] == creation_date_path:
+            creation_date = datetime.fromisoformat(element.get('value'))
+        elif element_path[1:] == gps_group_path:
+            in_gps_group = element.get('name') == 'ExifGPS'
+        elif in_gps_group and element_path[1:] == gps_item_path:
+            # GPS records start a bit later then the video itself
+            if element.get('name') == 'TimeStamp':
+                gps_timestamp = time.fromisoformat(element.get('value'))
+            elif element.get('name') == 'DateStamp':
+                gps_datestamp = date.fromisoformat(element.get('value').replace(':', '-'))
+
+    missing_elements = [element_name for element_name, value in [('CreationDate', creation_date),
+                                                                 ('ExifGPS TimeStamp', gps_timestamp),
+                                                                 ('ExifGPS DateStamp', gps_datestamp)]
+                        if value is None]
+    if missing_elements:
+        raise ValueError(f"{', '.join(missing_elements)} not found in metadata {metadata_filename}")
     logger.debug(f"CreationDate from metadata: {creation_date}")
-
-    # GPS records start a bit later then the video itself
-    gps_timestamp_element = tree.find(f"./{{{SONY_META_XMLNS}}}AcquisitionRecord/"
-                                      f"{{{SONY_META_XMLNS}}}Group[@name='ExifGPS']/"
-                                      f"{{{SONY_META_XMLNS}}}Item[@name='TimeStamp']")
-    gps_timestamp = time.fromisoformat(gps_timestamp_element.attrib['value'])
-    gps_datestamp_element = tree.find(f"./{{{SONY_META_XMLNS}}}AcquisitionRecord/"
-                                      f"{{{SONY_META_XMLNS}}}Group[@name='ExifGPS']/"
-                                      f"{{{SONY_META_XMLNS}}}Item[@name='DateStamp']")
-    gps_datestamp = date.fromisoformat(gps_datestamp_element.attrib['value'].replace(':', '-'))
     logger.debug(f"GPS date: {gps_datestamp}, time: {gps_timestamp}")
 
     delta = time_to_timedelta(telemetry_start_time) - time_to_timedelta(creation_date.astimezone(timezone.utc).time())
@@ -190,21 +335,21 @@ if __name__ == '__main__':
     logger.info(f"Merging video {args.video} into vbox {args.vbox} as {merged_vbox_filename}")
 
     with open(args.vbox) as vbox_file:
-        vbox_lines = vbox_file.readlines()
-        logger.debug(f"VBox lines read: {len(vbox_lines)}")
-
-        vbox_section_contents = read_vbox_sections(vbox_lines)
+        vbox_section_contents = read_vbox_sections(vbox_file)
+        logger.debug(f"VBox data lines read: {len(vbox_section_contents.data.lines)}")
+        telemetry_column_names = get_telemetry_column_names(vbox_section_contents)
         # TODO: print venue and date from comment instead
-        logger.info(f"VBox preamble: {vbox_section_contents[VBOX_PREAMBLE_SECTION][0]}")
+        logger.info(f"VBox preamble: {vbox_section_contents.preamble[0]}")
 
-        video_filename_match = re.fullmatch(r'(?P<prefix>[a-zA-Z]+)(?P<number>\d+).(?P<extension>\w+)', args.video)
+        video_filename_match = VIDEO_FILENAME_RE.fullmatch(args.video)
+        if not video_filename_match:
+            parser.error(f"video filename {args.video} should be an alpha prefix followed by a number and an extension")
         video_prefix = video_filename_match.group('prefix')
         video_number = video_filename_match.group('number')
         video_extension = video_filename_match.group('extension')
         logger.debug(f"Video file prefix: {video_prefix}, number: {video_number}, extension: {video_extension}")
 
-        telemetry_start_time = get_telemetry_start_time(vbox_section_contents,
-                                                        get_telemetry_column_names(vbox_section_contents))
+        telemetry_start_time_msec, telemetry_start_time = get_telemetry_start_time(vbox_section_contents)
         logger.debug(f"Telemetry start time: {telemetry_start_time}")
 
         video_offset_sec = args.video_offset_sec
@@ -215,8 +360,8 @@ if __name__ == '__main__':
         logger.info(f"Video offset to be used: {video_offset_sec}s")
 
         patch_headers(vbox_section_contents)
-        telemetry_column_names = patch_column_names(vbox_section_contents)
+        patch_column_names(vbox_section_contents, telemetry_column_names)
         insert_avi_section(vbox_section_contents, video_prefix, video_extension)
-        patch_data(vbox_section_contents, telemetry_column_names, video_number, video_offset_sec)
+        patch_data(vbox_section_contents, video_number, video_offset_sec, telemetry_start_time_msec)
 
         write_vbox_sections(vbox_section_contents, merged_vbox_filename)